@@ -8,6 +8,11 @@ MAX_CONCURRENCY = 10
 NUM_WORKERS = 32
 PRINT_NUM_VIS_TOKENS = False
 SKIP_REPEAT = True
+# Opt-in: lossy int8 SAM/CLIP linears (needs bitsandbytes)
+QUANTIZE_VISION = False
+COMPILE_VISION = False
+# Opt-in: reuse SAM/CLIP features for crops repeated across pages (hashes every crop)
+CACHE_VISION_CROPS = False
 
 MODEL_PATH = r'/home/hansonwen/DeepSeek-OCR-Web/deepseek-ocr'
 INPUT_PATH = r'/home/hansonwen/DeepSeek-OCR-Web/workspace/uploads/user_upload_20251129_145417_2e1f8489.pdf'
@@ -15,5 +20,25 @@ OUTPUT_PATH = r'/home/hansonwen/DeepSeek-OCR-Web/workspace/results/ocr_task_9533
 PROMPT = """<image>
 <|grounding|>Convert the document to markdown."""
 
+import hashlib
+import pickle
+from pathlib import Path
 from transformers import AutoTokenizer
-TOKENIZER = AutoTokenizer.from_pretrained(MODEL_PATH, trust_remote_code=True)
\ No newline at end of file
+
+# Reuse the tokenizer across tasks instead of re-parsing tokenizer.json every run;
+# the cache is keyed by model path and invalidated when tokenizer.json changes
+# (same workspace/logs directory as config_loader.LOGS_DIR, without importing its .env handling)
+_TOKENIZER_CACHE = Path(__file__).resolve().parent.parent / 'workspace' / 'logs' / f'tok_{hashlib.md5(MODEL_PATH.encode()).hexdigest()}.pkl'
+_TOKENIZER_JSON = Path(MODEL_PATH) / 'tokenizer.json'
+_TOKENIZER_MTIME = _TOKENIZER_JSON.stat().st_mtime if _TOKENIZER_JSON.exists() else None
+try:
+    _cached_mtime, TOKENIZER = pickle.loads(_TOKENIZER_CACHE.read_bytes())
+    if _cached_mtime != _TOKENIZER_MTIME:
+        raise ValueError('stale tokenizer cache')
+except Exception:
+    TOKENIZER = AutoTokenizer.from_pretrained(MODEL_PATH, trust_remote_code=True)
+    try:
+        _TOKENIZER_CACHE.parent.mkdir(parents=True, exist_ok=True)
+        _TOKENIZER_CACHE.write_bytes(pickle.dumps((_TOKENIZER_MTIME, TOKENIZER)))
+    except Exception as e:
+        print(f'⚠️ Could not write tokenizer cache {_TOKENIZER_CACHE}: {e}')
\ No newline at end of file
@@ -5,7 +5,12 @@ Hugging Face Transformers-based DeepSeek OCR model wrapper.
 This replaces vLLM for inference on systems where vLLM is incompatible.
 """
 
+import hashlib
+import json
 import math
+import os
+import struct
+from collections import OrderedDict
 import torch
 import torch.nn as nn
 from typing import List, Optional, Tuple
@@ -17,7 +22,75 @@ from deepencoder.sam_vary_sdpa import build_sam_vit_b
 from deepencoder.clip_sdpa import build_clip_l
 from deepencoder.build_linear import MlpProjector
 from process.image_process import DeepseekOCRProcessor
-from config import IMAGE_SIZE, BASE_SIZE, CROP_MODE, PRINT_NUM_VIS_TOKENS
+from config import IMAGE_SIZE, BASE_SIZE, CROP_MODE, PRINT_NUM_VIS_TOKENS, QUANTIZE_VISION, COMPILE_VISION, CACHE_VISION_CROPS
+
+
+_PROCESSOR = None
+_SAM_PREFIX = "model.sam_model."
+_CLIP_PREFIX = "model.vision_model."
+_PROJECTOR_PREFIX = "model.projector."
+_SPECIAL_TOKEN_KEYS = ("model.image_newline", "model.view_seperator")
+
+
+def _materialize_encoder(module: nn.Module, build, state: dict, name: str) -> nn.Module:
+    """
+    Return a meta-built encoder once the checkpoint has replaced all its tensors.
+    If anything is still on the meta device (a buffer or weight the checkpoint
+    does not carry), rebuild the encoder for real and load the state again.
+    """
+    tensors = list(module.parameters()) + list(module.buffers())
+    if not any(t.is_meta for t in tensors):
+        return module
+    print(f"  ⚠️ Checkpoint does not cover every {name} tensor, building it on CPU")
+    module = build()
+    if state:
+        module.load_state_dict(state, strict=False, assign=True)
+    return module
+
+
+def get_processor() -> DeepseekOCRProcessor:
+    """Return a shared DeepseekOCRProcessor, building it on first use."""
+    global _PROCESSOR
+    if _PROCESSOR is None:
+        _PROCESSOR = DeepseekOCRProcessor()
+    return _PROCESSOR
+
+
+def _is_vision_weight(key: str) -> bool:
+    """Whether a checkpoint key belongs to the vision path (SAM / CLIP / projector / special tokens)."""
+    return key.startswith((_SAM_PREFIX, _CLIP_PREFIX, _PROJECTOR_PREFIX)) or key in _SPECIAL_TOKEN_KEYS
+
+
+def _prefetch_safetensors(path: str, merge_gap: int = 4 << 20):
+    """
+    Ask the kernel to read ahead the byte ranges holding vision weights in a shard.
+    
+    Faulting an mmap in page by page turns into many small reads, which is
+    slow on network mounts; POSIX_FADV_WILLNEED on the (merged) tensor ranges
+    lets the page cache fill with large sequential IOs before safe_open
+    touches them. Language model tensors are skipped, so they are never read.
+    """
+    if not hasattr(os, "posix_fadvise"):
+        return
+    with open(path, "rb") as f:
+        header_len = struct.unpack("<Q", f.read(8))[0]
+        header = json.loads(f.read(header_len))
+        data_start = 8 + header_len
+        
+        ranges = sorted(
+            (data_start + info["data_offsets"][0], data_start + info["data_offsets"][1])
+            for key, info in header.items()
+            if key != "__metadata__" and _is_vision_weight(key)
+        )
+        merged = []
+        for start, end in ranges:
+            if merged and start - merged[-1][1] <= merge_gap:
+                merged[-1][1] = max(merged[-1][1], end)
+            else:
+                merged.append([start, end])
+        
+        for start, end in merged:
+            os.posix_fadvise(f.fileno(), start, end - start, os.POSIX_FADV_WILLNEED)
 
 
 class HFDeepseekOCR(nn.Module):
@@ -32,6 +105,11 @@ class HFDeepseekOCR(nn.Module):
         self.device = device
         self.dtype = dtype
         self.model_path = model_path
+        # Side stream for host-to-device image copies, overlapped with encoder compute
+        self.copy_stream = torch.cuda.Stream() if torch.device(device).type == "cuda" else None
+        # LRU of projected crop features keyed by crop content (repeated blank/header crops in PDFs)
+        self._vision_cache = OrderedDict()
+        self._vision_cache_size = 256
         
         print(f"🔄 Loading DeepSeek OCR model from {model_path}...")
         
@@ -40,12 +118,15 @@ class HFDeepseekOCR(nn.Module):
         self.image_token = "<image>"
         self.image_token_id = self.tokenizer.vocab.get(self.image_token)
         
-        # Load vision encoders
+        # Load vision encoders; built on the meta device so no memory is allocated or
+        # randomly initialized for weights the checkpoint overwrites (see _load_vision_weights)
         print("  📷 Loading SAM vision encoder...")
-        self.sam_model = build_sam_vit_b()
+        with torch.device("meta"):
+            self.sam_model = build_sam_vit_b()
         
         print("  📷 Loading CLIP vision encoder...")
-        self.vision_model = build_clip_l()
+        with torch.device("meta"):
+            self.vision_model = build_clip_l()
         
         # Load projector
         n_embed = 1280
@@ -61,6 +142,8 @@ class HFDeepseekOCR(nn.Module):
         import sys
         sys.path.insert(0, model_path)
         
+        placement = self._language_model_placement(model_path)
+        
         try:
             # Try loading with trust_remote_code which should use the model's custom class
             from transformers import AutoModel
@@ -68,7 +151,7 @@ class HFDeepseekOCR(nn.Module):
                 model_path,
                 torch_dtype=dtype,
                 trust_remote_code=True,
-                device_map="auto",
+                **placement,
             )
         except Exception as e:
             print(f"  ⚠️ AutoModel failed: {e}")
@@ -87,75 +170,346 @@ class HFDeepseekOCR(nn.Module):
                     model_path,
                     torch_dtype=dtype,
                     trust_remote_code=True,
-                    device_map="auto",
                     ignore_mismatched_sizes=True,
+                    **placement,
                 )
             except Exception as e2:
                 print(f"  ❌ Language model loading failed: {e2}")
                 raise RuntimeError(f"Could not load language model: {e2}")
         
+        if "device_map" not in placement:
+            self.language_model = self.language_model.to(device)
+        
         # Load vision weights from the checkpoint
         self._load_vision_weights(model_path)
         
-        # Move vision components to device
+        # Move anything the checkpoint did not cover to device; loaded weights
+        # already live on the target device/dtype, so this is a no-op for them
         self.sam_model = self.sam_model.to(device=device, dtype=dtype)
         self.vision_model = self.vision_model.to(device=device, dtype=dtype)
         self.projector = self.projector.to(device=device, dtype=dtype)
         self.image_newline = nn.Parameter(self.image_newline.to(device=device, dtype=dtype))
         self.view_seperator = nn.Parameter(self.view_seperator.to(device=device, dtype=dtype))
         
+        # channels_last conv weights pick the faster cuDNN / tensor-core kernels for SAM's convs
+        self.sam_model = self.sam_model.to(memory_format=torch.channels_last)
+        
+        # Quantize the SAM / CLIP linears; the projector and special tokens stay in bf16
+        if QUANTIZE_VISION:
+            self._quantize_vision_encoders()
+        
         # Set to eval mode
         self.eval()
         
+        # Optionally compile the per-image vision path so Inductor can fuse the encoder
+        # tail (cat / view / permute / projector) and capture it in CUDA graphs.
+        # Off by default: dynamo is unreliable on the Blackwell / nightly stacks this class targets,
+        # and a CUDA graph is recorded per distinct crop grid.
+        if COMPILE_VISION:
+            self._encode_one = torch.compile(
+                self._encode_one, mode="reduce-overhead", dynamic=True, fullgraph=False
+            )
+        
         print("✅ Model loaded successfully!")
     
+    def _language_model_placement(self, model_path: str) -> dict:
+        """
+        Pick from_pretrained() placement kwargs for the language model.
+        
+        When the checkpoint fits on the target GPU it is loaded onto that single
+        device; accelerate's ``device_map="auto"`` is only used when it does
+        not, since splitting the model adds cross-device copies to every decode step.
+        """
+        import glob
+        
+        device = torch.device(self.device)
+        if device.type != "cuda" or not torch.cuda.is_available():
+            return {"low_cpu_mem_usage": True}
+        
+        # Checkpoint size on disk approximates the bf16 weight footprint
+        checkpoint_bytes = sum(os.path.getsize(f) for f in glob.glob(os.path.join(model_path, "*.safetensors")))
+        total_memory = torch.cuda.get_device_properties(device.index or 0).total_memory
+        if checkpoint_bytes and checkpoint_bytes < 0.9 * total_memory:
+            return {"low_cpu_mem_usage": True}
+        
+        print(f"  ⚠️ Checkpoint ({checkpoint_bytes / 2**30:.1f} GiB) may not fit on {device}, using device_map='auto'")
+        return {"device_map": "auto"}
+    
     def _load_vision_weights(self, model_path: str):
         """Load vision encoder weights from the model checkpoint."""
-        import os
         import glob
         
-        # Find safetensors or bin files
+        # Only safetensors checkpoints are supported (pickle-based .bin files are slower and unsafe)
         safetensor_files = glob.glob(os.path.join(model_path, "*.safetensors"))
-        bin_files = glob.glob(os.path.join(model_path, "*.bin"))
-        
-        if safetensor_files:
-            from safetensors.torch import load_file
-            state_dict = {}
-            for f in safetensor_files:
-                state_dict.update(load_file(f))
-        elif bin_files:
-            state_dict = {}
-            for f in bin_files:
-                state_dict.update(torch.load(f, map_location="cpu"))
-        else:
-            print("  ⚠️ No checkpoint files found, using randomly initialized vision weights")
-            return
+        if not safetensor_files:
+            raise FileNotFoundError(
+                f"No .safetensors checkpoint found in {model_path}. "
+                "Convert the weights with transformers, e.g. "
+                "model.save_pretrained(path, safe_serialization=True)."
+            )
+        
+        sam_state, clip_state, proj_state, special_state = {}, {}, {}, {}
         
-        # Extract and load SAM weights
-        sam_state = {k.replace("model.sam_model.", ""): v for k, v in state_dict.items() if "sam_model" in k}
+        def _route(k, get_tensor):
+            # Only materialize tensors that belong to the vision path (routed by exact
+            # prefix), casting as we go so a full-precision copy is never kept around
+            if k.startswith(_SAM_PREFIX):
+                sam_state[k[len(_SAM_PREFIX):]] = get_tensor(k).to(self.dtype)
+            elif k.startswith(_CLIP_PREFIX):
+                clip_state[k[len(_CLIP_PREFIX):]] = get_tensor(k).to(self.dtype)
+            elif k.startswith(_PROJECTOR_PREFIX) and "vision" not in k:
+                proj_state[k[len(_PROJECTOR_PREFIX):]] = get_tensor(k).to(self.dtype)
+            elif k in _SPECIAL_TOKEN_KEYS:
+                special_state[k] = get_tensor(k).to(self.dtype)
+        
+        from concurrent.futures import ThreadPoolExecutor
+        from safetensors import safe_open
+        
+        def _read_shard(f):
+            try:
+                _prefetch_safetensors(f)
+            except Exception as e:
+                print(f"  ⚠️ Could not prefetch {os.path.basename(f)}: {e}")
+            
+            # safe_open mmaps the shard; unused language model tensors are never read,
+            # and the ones we need are copied straight to the target device
+            with safe_open(f, framework="pt", device=str(self.device)) as shard:
+                for k in shard.keys():
+                    _route(k, shard.get_tensor)
+        
+        with ThreadPoolExecutor(max_workers=len(safetensor_files)) as executor:
+            list(executor.map(_read_shard, safetensor_files))
+        
+        # Load SAM weights
         if sam_state:
-            self.sam_model.load_state_dict(sam_state, strict=False)
+            self.sam_model.load_state_dict(sam_state, strict=False, assign=True)
             print(f"  ✅ Loaded {len(sam_state)} SAM weights")
+        self.sam_model = _materialize_encoder(self.sam_model, build_sam_vit_b, sam_state, "SAM")
         
-        # Extract and load CLIP weights
-        clip_state = {k.replace("model.vision_model.", ""): v for k, v in state_dict.items() if "vision_model" in k}
+        # Load CLIP weights
         if clip_state:
-            self.vision_model.load_state_dict(clip_state, strict=False)
+            self.vision_model.load_state_dict(clip_state, strict=False, assign=True)
             print(f"  ✅ Loaded {len(clip_state)} CLIP weights")
+        self.vision_model = _materialize_encoder(self.vision_model, build_clip_l, clip_state, "CLIP")
         
-        # Extract and load projector weights
-        proj_state = {k.replace("model.projector.", ""): v for k, v in state_dict.items() if "projector" in k and "vision" not in k}
+        # Load projector weights
         if proj_state:
-            self.projector.load_state_dict(proj_state, strict=False)
+            self.projector.load_state_dict(proj_state, strict=False, assign=True)
             print(f"  ✅ Loaded {len(proj_state)} projector weights")
         
         # Load special tokens
-        if "model.image_newline" in state_dict:
-            self.image_newline = nn.Parameter(state_dict["model.image_newline"])
-        if "model.view_seperator" in state_dict:
-            self.view_seperator = nn.Parameter(state_dict["model.view_seperator"])
+        if "model.image_newline" in special_state:
+            self.image_newline = nn.Parameter(special_state["model.image_newline"])
+        if "model.view_seperator" in special_state:
+            self.view_seperator = nn.Parameter(special_state["model.view_seperator"])
+    
+    def _quantize_vision_encoders(self):
+        """Swap every nn.Linear in SAM and CLIP for a bitsandbytes int8 linear."""
+        if torch.device(self.device).type != "cuda":
+            return
+        try:
+            import bitsandbytes as bnb
+        except ImportError:
+            print("  ⚠️ bitsandbytes not installed, keeping vision encoders in full precision")
+            return
+        
+        num_quantized = 0
+        for encoder in (self.sam_model, self.vision_model):
+            for parent in list(encoder.modules()):
+                for name, child in list(parent.named_children()):
+                    if type(child) is not nn.Linear:
+                        continue
+                    qlinear = bnb.nn.Linear8bitLt(
+                        child.in_features,
+                        child.out_features,
+                        bias=child.bias is not None,
+                        has_fp16_weights=False,
+                        threshold=6.0,
+                    )
+                    # Int8Params quantizes when moved from host to GPU
+                    qlinear.weight = bnb.nn.Int8Params(
+                        child.weight.data.cpu(), requires_grad=False, has_fp16_weights=False
+                    )
+                    if child.bias is not None:
+                        qlinear.bias = nn.Parameter(child.bias.data, requires_grad=False)
+                    setattr(parent, name, qlinear.to(self.device))
+                    num_quantized += 1
+        
+        print(f"  ✅ Quantized {num_quantized} vision encoder linears to int8")
     
-    @torch.no_grad()
+    def _encode_views(self, images: torch.Tensor) -> torch.Tensor:
+        """Run SAM + CLIP on a batch of views and project to the LM embedding space."""
+        features_1 = self.sam_model(images)
+        features_2 = self.vision_model(images, features_1)
+        features = torch.cat(
+            (features_2[:, 1:], features_1.flatten(2).permute(0, 2, 1)), 
+            dim=-1
+        )
+        return self.projector(features)
+    
+    def _append_newline(self, features: torch.Tensor, rows: int, cols: int) -> torch.Tensor:
+        """
+        Append ``image_newline`` after each of ``rows`` rows of ``cols`` tokens and flatten.
+        
+        ``features`` may be any (possibly permuted) view whose shape splits
+        ``[rows, cols, n_dim]``; it is written straight into a preallocated
+        ``[rows, cols + 1, n_dim]`` buffer rather than going through reshape + cat.
+        """
+        n_dim = features.shape[-1]
+        out = torch.empty((rows, cols + 1, n_dim), device=features.device, dtype=features.dtype)
+        out[:, :cols].view(features.shape).copy_(features)
+        out[:, cols] = self.image_newline  # broadcasts over rows
+        return out.view(-1, n_dim)
+    
+    def _encode_one(
+        self,
+        patches: torch.Tensor,
+        image_ori: torch.Tensor,
+        width_crop_num: int,
+        height_crop_num: int,
+        local_features: Optional[torch.Tensor] = None,
+    ) -> torch.Tensor:
+        """
+        Encode a single image (global view + optional crops) into its vision tokens.
+        
+        The crop grid is passed as Python ints so the compiled graph only
+        specializes on the branch taken, not on tensor values. Crop features
+        that were already looked up in the vision cache can be passed in as
+        ``local_features``, in which case only the global view is encoded.
+        """
+        if width_crop_num > 1 or height_crop_num > 1:  # Has crops
+            if local_features is not None:
+                global_features = self._encode_views(image_ori)
+            elif image_ori.shape[-2:] == patches.shape[-2:]:
+                # Same resolution: run global view and crops through the encoders as one batch
+                features = self._encode_views(torch.cat([image_ori, patches], dim=0))
+                global_features, local_features = features[:1], features[1:]
+            else:
+                # Process local patches
+                local_features = self._encode_views(patches)
+                
+                # Process global view
+                global_features = self._encode_views(image_ori)
+            
+            if PRINT_NUM_VIS_TOKENS:
+                print('=====================')
+                print('BASE: ', global_features.shape)
+                print('PATCHES: ', local_features.shape)
+                print('=====================')
+            
+            _, hw, n_dim = global_features.shape
+            h = w = int(hw ** 0.5)
+            
+            _, hw2, n_dim2 = local_features.shape
+            h2 = w2 = int(hw2 ** 0.5)
+            
+            # Format global features with newlines
+            global_features = self._append_newline(global_features.view(h, w, n_dim), h, w)
+            
+            # Format local features with newlines
+            local_features = local_features.view(
+                height_crop_num, width_crop_num, h2, w2, n_dim2
+            ).permute(0, 2, 1, 3, 4)
+            local_features = self._append_newline(local_features, height_crop_num * h2, width_crop_num * w2)
+            
+            # Combine local + global + separator
+            global_local_features = torch.cat(
+                [local_features, global_features, self.view_seperator[None, :]], 
+                dim=0
+            )
+        else:
+            # No crops, only global view
+            global_features = self._encode_views(image_ori)
+            
+            if PRINT_NUM_VIS_TOKENS:
+                print('=====================')
+                print('BASE: ', global_features.shape)
+                print('NO PATCHES')
+                print('=====================')
+            
+            _, hw, n_dim = global_features.shape
+            h = w = int(hw ** 0.5)
+            
+            global_features = self._append_newline(global_features.view(h, w, n_dim), h, w)
+            
+            global_local_features = torch.cat(
+                [global_features, self.view_seperator[None, :]], 
+                dim=0
+            )
+        
+        return global_local_features
+    
+    def _stage_inputs(
+        self,
+        pixel_values: torch.Tensor,
+        images_crop: torch.Tensor,
+        jdx: int,
+    ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        """
+        Copy one image's crops and global view to the device.
+        
+        On CUDA the copy is issued on ``self.copy_stream`` so it can overlap
+        with the encoder work for the previous image; callers must wait on
+        that stream before using the returned tensors. The host-side crops
+        are returned as well for the vision cache lookup.
+        """
+        # images_crop shape: [batch, n_crops, 3, h, w] or [batch, 1, n_crops, 3, h, w]
+        # We need patches as [n_crops, 3, h, w]
+        if images_crop.dim() == 5:
+            patches = images_crop[jdx]  # [n_crops, 3, h, w]
+        else:
+            patches = images_crop[jdx][0]  # Handle nested case
+        
+        # pixel_values shape: [batch, 1, 3, H, W] or [batch, 3, H, W]
+        if pixel_values.dim() == 5:
+            image_ori = pixel_values[jdx]  # [1, 3, H, W]
+        else:
+            image_ori = pixel_values[jdx].unsqueeze(0)  # Add batch dim
+        
+        # Inputs are laid out channels_last to match the SAM patch-embedding conv
+        host_patches = patches
+        if self.copy_stream is None:
+            patches = patches.to(self.dtype).to(self.device, memory_format=torch.channels_last)
+            image_ori = image_ori.to(self.dtype).to(self.device, memory_format=torch.channels_last)
+            return patches, image_ori, host_patches
+        
+        with torch.cuda.stream(self.copy_stream):
+            patches = patches.to(self.device, non_blocking=True).to(self.dtype, memory_format=torch.channels_last)
+            image_ori = image_ori.to(self.device, non_blocking=True).to(self.dtype, memory_format=torch.channels_last)
+        return patches, image_ori, host_patches
+    
+    def _encode_crops_cached(self, patches: torch.Tensor, host_patches: torch.Tensor) -> torch.Tensor:
+        """
+        Encode crops through SAM + CLIP + projector, reusing features for crops seen before.
+        
+        Crops are keyed by a hash of their host-side pixels, so only crops
+        missing from the cache are sent through the encoders. Opt-in
+        (CACHE_VISION_CROPS): hashing every crop costs more than it saves
+        unless pages really repeat.
+        """
+        keys = [
+            hashlib.blake2b(crop.detach().cpu().contiguous().numpy(), digest_size=16).hexdigest()
+            for crop in host_patches
+        ]
+        
+        missing = [i for i, key in enumerate(keys) if key not in self._vision_cache]
+        if missing:
+            features = self._encode_views(patches[missing])
+            for i, feature in zip(missing, features):
+                self._vision_cache[keys[i]] = feature.clone()
+        
+        local_features = []
+        for key in keys:
+            self._vision_cache.move_to_end(key)
+            local_features.append(self._vision_cache[key])
+        local_features = torch.stack(local_features, dim=0)
+        
+        while len(self._vision_cache) > self._vision_cache_size:
+            self._vision_cache.popitem(last=False)
+        
+        return local_features
+    
+    @torch.inference_mode()
     def encode_images(
         self,
         pixel_values: torch.Tensor,
@@ -166,29 +520,36 @@ class HFDeepseekOCR(nn.Module):
         Encode images using vision encoders.
         
         Args:
-            pixel_values: Global view images [n_images, 3, H, W]
-            images_crop: Local crop images [n_images, n_crops, 3, h, w]
-            images_spatial_crop: Crop grid info [n_images, 2]
+            pixel_values: Global view images [n_images, 3, H, W] (host tensors)
+            images_crop: Local crop images [n_images, n_crops, 3, h, w] (host tensors)
+            images_spatial_crop: Crop grid info [n_images, 2] (kept on CPU)
         
         Returns:
             List of image embeddings
         """
         images_in_this_batch = []
         n_embed = self.projector.cfg.n_embed
-        
-        for jdx in range(images_spatial_crop.size(0)):
-            # images_crop shape: [batch, n_crops, 3, h, w] or [batch, 1, n_crops, 3, h, w]
-            # We need patches as [n_crops, 3, h, w]
-            if images_crop.dim() == 5:
-                patches = images_crop[jdx].to(self.dtype).to(self.device)  # [n_crops, 3, h, w]
-            else:
-                patches = images_crop[jdx][0].to(self.dtype).to(self.device)  # Handle nested case
+        n_images = images_spatial_crop.size(0)
+        
+        # Pinned host memory is what lets the copy-stream transfers run asynchronously
+        if self.copy_stream is not None:
+            if pixel_values.device.type == "cpu" and not pixel_values.is_pinned():
+                pixel_values = pixel_values.pin_memory()
+            if images_crop.device.type == "cpu" and not images_crop.is_pinned():
+                images_crop = images_crop.pin_memory()
+        
+        staged = self._stage_inputs(pixel_values, images_crop, 0)
+        for jdx in range(n_images):
+            patches, image_ori, host_patches = staged
+            if self.copy_stream is not None:
+                compute_stream = torch.cuda.current_stream()
+                compute_stream.wait_stream(self.copy_stream)
+                patches.record_stream(compute_stream)
+                image_ori.record_stream(compute_stream)
             
-            # pixel_values shape: [batch, 1, 3, H, W] or [batch, 3, H, W]
-            if pixel_values.dim() == 5:
-                image_ori = pixel_values[jdx].to(self.dtype).to(self.device)  # [1, 3, H, W]
-            else:
-                image_ori = pixel_values[jdx].unsqueeze(0).to(self.dtype).to(self.device)  # Add batch dim
+            # Kick off the next image's copy while this one is being encoded
+            if jdx + 1 < n_images:
+                staged = self._stage_inputs(pixel_values, images_crop, jdx + 1)
             
             # images_spatial_crop shape: [batch, 1, 2] or [batch, 2]
             if images_spatial_crop.dim() == 3:
@@ -196,93 +557,22 @@ class HFDeepseekOCR(nn.Module):
             else:
                 crop_shape = images_spatial_crop[jdx]  # [2]
             
-            if torch.sum(patches).item() != 0:  # Has crops
-                # Process local patches
-                local_features_1 = self.sam_model(patches)
-                local_features_2 = self.vision_model(patches, local_features_1)
-                local_features = torch.cat(
-                    (local_features_2[:, 1:], local_features_1.flatten(2).permute(0, 2, 1)), 
-                    dim=-1
-                )
-                local_features = self.projector(local_features)
-                
-                # Process global view
-                global_features_1 = self.sam_model(image_ori)
-                global_features_2 = self.vision_model(image_ori, global_features_1)
-                global_features = torch.cat(
-                    (global_features_2[:, 1:], global_features_1.flatten(2).permute(0, 2, 1)), 
-                    dim=-1
-                )
-                global_features = self.projector(global_features)
-                
-                if PRINT_NUM_VIS_TOKENS:
-                    print('=====================')
-                    print('BASE: ', global_features.shape)
-                    print('PATCHES: ', local_features.shape)
-                    print('=====================')
-                
-                _, hw, n_dim = global_features.shape
-                h = w = int(hw ** 0.5)
-                
-                _, hw2, n_dim2 = local_features.shape
-                h2 = w2 = int(hw2 ** 0.5)
-                
-                width_crop_num, height_crop_num = crop_shape[0].item(), crop_shape[1].item()
-                
-                # Format global features with newlines
-                global_features = global_features.view(h, w, n_dim)
-                global_features = torch.cat(
-                    [global_features, self.image_newline[None, None, :].expand(h, 1, n_dim)], 
-                    dim=1
-                )
-                global_features = global_features.view(-1, n_dim)
-                
-                # Format local features with newlines
-                local_features = local_features.view(
-                    height_crop_num, width_crop_num, h2, w2, n_dim2
-                ).permute(0, 2, 1, 3, 4).reshape(height_crop_num * h2, width_crop_num * w2, n_dim2)
-                local_features = torch.cat(
-                    [local_features, self.image_newline[None, None, :].expand(height_crop_num * h2, 1, n_dim2)], 
-                    dim=1
-                )
-                local_features = local_features.view(-1, n_dim2)
-                
-                # Combine local + global + separator
-                global_local_features = torch.cat(
-                    [local_features, global_features, self.view_seperator[None, :]], 
-                    dim=0
-                )
-            else:
-                # No crops, only global view
-                global_features_1 = self.sam_model(image_ori)
-                global_features_2 = self.vision_model(image_ori, global_features_1)
-                global_features = torch.cat(
-                    (global_features_2[:, 1:], global_features_1.flatten(2).permute(0, 2, 1)), 
-                    dim=-1
-                )
-                global_features = self.projector(global_features)
-                
-                if PRINT_NUM_VIS_TOKENS:
-                    print('=====================')
-                    print('BASE: ', global_features.shape)
-                    print('NO PATCHES')
-                    print('=====================')
-                
-                _, hw, n_dim = global_features.shape
-                h = w = int(hw ** 0.5)
-                
-                global_features = global_features.view(h, w, n_dim)
-                global_features = torch.cat(
-                    [global_features, self.image_newline[None, None, :].expand(h, 1, n_dim)], 
-                    dim=1
-                )
-                global_features = global_features.view(-1, n_dim)
-                
-                global_local_features = torch.cat(
-                    [global_features, self.view_seperator[None, :]], 
-                    dim=0
-                )
+            # The crop grid is host-resident, so deciding whether there are crops
+            # needs no device sync (the processor only emits crops for grids > 1x1)
+            width_crop_num, height_crop_num = crop_shape.tolist()
             
+            local_features = None
+            if CACHE_VISION_CROPS and (width_crop_num > 1 or height_crop_num > 1):
+                local_features = self._encode_crops_cached(patches, host_patches)
+            
+            global_local_features = self._encode_one(
+                patches, image_ori, width_crop_num, height_crop_num, local_features
+            )
+            
+            # CUDA-graph outputs are reused by the next replay, so keep our own copy;
+            # the eager path already returns a fresh tensor
+            if COMPILE_VISION:
+                global_local_features = global_local_features.clone()
             images_in_this_batch.append(global_local_features)
         
         return images_in_this_batch
@@ -299,45 +589,22 @@ class HFDeepseekOCR(nn.Module):
         inputs_embeds = self.language_model.get_input_embeddings()(input_ids)
         
         if image_embeddings is not None and len(image_embeddings) > 0:
-            # Find image token positions and merge
-            batch_size = input_ids.shape[0]
+            # Scatter all image embeddings into the <image> positions in one shot
+            image_mask = input_ids == self.image_token_id
+            num_image_tokens = int(image_mask.sum().item())
+            num_image_embeds = sum(img_embed.shape[0] for img_embed in image_embeddings)
+            if num_image_tokens != num_image_embeds:
+                raise ValueError(
+                    f"Number of <image> tokens ({num_image_tokens}) does not match "
+                    f"number of image embeddings ({num_image_embeds})"
+                )
             
-            for batch_idx in range(batch_size):
-                image_mask = input_ids[batch_idx] == self.image_token_id
-                image_positions = torch.where(image_mask)[0]
-                
-                if len(image_positions) > 0 and batch_idx < len(image_embeddings):
-                    img_embed = image_embeddings[batch_idx]
-                    
-                    # Replace image tokens with image embeddings
-                    num_image_tokens = len(image_positions)
-                    if num_image_tokens == img_embed.shape[0]:
-                        inputs_embeds[batch_idx, image_positions] = img_embed
-                    else:
-                        # Handle mismatch - expand embeddings
-                        start_pos = image_positions[0].item()
-                        end_pos = image_positions[-1].item() + 1
-                        
-                        # Create new embeddings tensor
-                        new_seq_len = inputs_embeds.shape[1] - num_image_tokens + img_embed.shape[0]
-                        new_embeds = torch.zeros(
-                            (new_seq_len, inputs_embeds.shape[2]),
-                            dtype=inputs_embeds.dtype,
-                            device=inputs_embeds.device
-                        )
-                        
-                        # Copy before image tokens
-                        new_embeds[:start_pos] = inputs_embeds[batch_idx, :start_pos]
-                        # Insert image embeddings
-                        new_embeds[start_pos:start_pos + img_embed.shape[0]] = img_embed
-                        # Copy after image tokens
-                        new_embeds[start_pos + img_embed.shape[0]:] = inputs_embeds[batch_idx, end_pos:]
-                        
-                        inputs_embeds = new_embeds.unsqueeze(0)
+            flat_embeds = torch.cat(image_embeddings, dim=0).to(inputs_embeds.dtype)
+            inputs_embeds.masked_scatter_(image_mask.unsqueeze(-1).expand_as(inputs_embeds), flat_embeds)
         
         return inputs_embeds
     
-    @torch.no_grad()
+    @torch.inference_mode()
     def generate(
         self,
         images: List[Image.Image],
@@ -361,7 +628,7 @@ class HFDeepseekOCR(nn.Module):
             Generated text
         """
         # Process images using the processor
-        processor = DeepseekOCRProcessor()
+        processor = get_processor()
         image_data = processor.tokenize_with_images(
             images=images,
             bos=True,
@@ -374,9 +641,9 @@ class HFDeepseekOCR(nn.Module):
         
         # Move to device
         input_ids = input_ids.to(self.device)
-        pixel_values = pixel_values.unsqueeze(0).to(self.device)
-        images_crop = images_crop.to(self.device)
-        images_spatial_crop = images_spatial_crop.unsqueeze(0).to(self.device)
+        # Image tensors stay on the host; encode_images() streams them to the device
+        pixel_values = pixel_values.unsqueeze(0)
+        images_spatial_crop = images_spatial_crop.unsqueeze(0)  # stays on CPU, only read for shapes
         
         # Encode images
         image_embeddings = self.encode_images(pixel_values, images_crop, images_spatial_crop)
@@ -407,7 +674,7 @@ class HFDeepseekOCR(nn.Module):
         
         return generated_text
     
-    @torch.no_grad()
+    @torch.inference_mode()
     def generate_batch(
         self,
         batch_inputs: List[dict],
@@ -425,14 +692,15 @@ class HFDeepseekOCR(nn.Module):
         Returns:
             List of generated texts
         """
-        results = []
+        results = [""] * len(batch_inputs)
+        sample_indices = []
+        sample_embeds = []
         
-        for batch_item in batch_inputs:
+        for idx, batch_item in enumerate(batch_inputs):
             # Extract data from batch item
             image_data = batch_item.get("multi_modal_data", {}).get("image", None)
             
             if image_data is None:
-                results.append("")
                 continue
             
             # Unpack processed data
@@ -440,9 +708,9 @@ class HFDeepseekOCR(nn.Module):
             
             # Move to device
             input_ids = input_ids.to(self.device)
-            pixel_values = pixel_values.unsqueeze(0).to(self.device)
-            images_crop = images_crop.to(self.device)
-            images_spatial_crop = images_spatial_crop.unsqueeze(0).to(self.device)
+            # Image tensors stay on the host; encode_images() streams them to the device
+            pixel_values = pixel_values.unsqueeze(0)
+            images_spatial_crop = images_spatial_crop.unsqueeze(0)  # stays on CPU, only read for shapes
             
             # Encode images
             image_embeddings = self.encode_images(pixel_values, images_crop, images_spatial_crop)
@@ -450,24 +718,45 @@ class HFDeepseekOCR(nn.Module):
             # Get input embeddings with images merged
             inputs_embeds = self.get_input_embeddings(input_ids, image_embeddings)
             
-            # Generate
-            generation_config = {
-                "max_new_tokens": max_new_tokens,
-                "do_sample": temperature > 0,
-                "pad_token_id": self.tokenizer.pad_token_id,
-                "eos_token_id": self.tokenizer.eos_token_id,
-            }
-            
-            if temperature > 0:
-                generation_config["temperature"] = temperature
-            
-            outputs = self.language_model.generate(
-                inputs_embeds=inputs_embeds,
-                **generation_config
-            )
-            
-            generated_text = self.tokenizer.decode(outputs[0], skip_special_tokens=False)
-            results.append(generated_text)
+            sample_indices.append(idx)
+            sample_embeds.append(inputs_embeds[0])
+        
+        if not sample_embeds:
+            return results
+        
+        # Left-pad every sample to the longest sequence so all of them decode in one generate call
+        max_len = max(embeds.shape[0] for embeds in sample_embeds)
+        padded_embeds = sample_embeds[0].new_zeros((len(sample_embeds), max_len, sample_embeds[0].shape[-1]))
+        attention_mask = torch.zeros((len(sample_embeds), max_len), dtype=torch.long, device=padded_embeds.device)
+        for row, embeds in enumerate(sample_embeds):
+            seq_len = embeds.shape[0]
+            padded_embeds[row, max_len - seq_len:] = embeds
+            attention_mask[row, max_len - seq_len:] = 1
+        
+        # Generate
+        generation_config = {
+            "max_new_tokens": max_new_tokens,
+            "do_sample": temperature > 0,
+            "pad_token_id": self.tokenizer.pad_token_id,
+            "eos_token_id": self.tokenizer.eos_token_id,
+        }
+        
+        if temperature > 0:
+            generation_config["temperature"] = temperature
+        
+        outputs = self.language_model.generate(
+            inputs_embeds=padded_embeds,
+            attention_mask=attention_mask,
+            **generation_config
+        )
+        
+        pad_token_id = self.tokenizer.pad_token_id
+        for row, idx in enumerate(sample_indices):
+            tokens = outputs[row]
+            # Shorter samples are padded after they hit EOS
+            if pad_token_id is not None:
+                tokens = tokens[tokens != pad_token_id]
+            results[idx] = self.tokenizer.decode(tokens, skip_special_tokens=False)
         
         return results
 
@@ -5,138 +5,222 @@ DeepSeek OCR Backend Core Executor
 Supports:
 - Automatic PDF / Image detection
 - Real-time progress callbacks
-- Temporary config.py override
-- Task state JSON persistence
+- In-process model worker (model loaded once at server startup)
+- Task state JSON persistence (in-memory, debounced to disk)
 - Runtime tracking
 - Console output streaming
 - Task cancellation
 """
 
-import json
+import asyncio
 import os
-import signal
-import subprocess
+import re
+import sys
 import threading
 import time
-from pathlib import Path
-from typing import Callable, Optional, Dict, Any
+from collections import OrderedDict
+from typing import Callable, Optional, Dict, Any, List
 from datetime import datetime
 
-from config_loader import MODEL_PATH, LOGS_DIR
+import orjson
+
+import ocr_worker
+from config_loader import LOGS_DIR
 from file_manager import detect_file_type, create_result_dir, list_result_files
 
-# Track running processes for cancellation
-_running_processes: Dict[str, subprocess.Popen] = {}
+# Log keywords used to estimate task progress
+_PROGRESS_RE = re.compile(r"(loading|pre-processed|generate|save results|result_with_boxes|complete)", re.IGNORECASE)
+_PROGRESS_MAP = {
+    "loading": 10,
+    "pre-processed": 30,
+    "generate": 60,
+    "save results": 90,
+    "result_with_boxes": 100,
+    "complete": 100,
+}
 
-# Core script paths
-PROJECT_ROOT = Path(__file__).resolve().parent
-# Use Hugging Face backend scripts (compatible with PyTorch nightly / Blackwell GPUs)
-PDF_SCRIPT = PROJECT_ROOT / "run_dpsk_ocr_pdf_hf.py"
-IMAGE_SCRIPT = PROJECT_ROOT / "run_dpsk_ocr_image_hf.py"
-# Fallback to vLLM scripts if HF scripts don't exist
-if not PDF_SCRIPT.exists():
-    PDF_SCRIPT = PROJECT_ROOT / "run_dpsk_ocr_pdf.py"
-if not IMAGE_SCRIPT.exists():
-    IMAGE_SCRIPT = PROJECT_ROOT / "run_dpsk_ocr_image.py"
-CONFIG_PATH = PROJECT_ROOT / "config.py"
+# Track running tasks for cancellation
+_running_tasks = set()
+_cancelled_tasks = set()
 
 
 # ====== Task State Persistence ======
-def write_task_state(task_id: str, state: Dict[str, Any]):
+# In-memory task states (source of truth while the server runs); disk writes are debounced
+_task_states: Dict[str, Dict[str, Any]] = {}
+_last_flush: Dict[str, float] = {}
+_state_lock = threading.Lock()
+_STATE_FLUSH_INTERVAL = 1.0
+_TERMINAL_STATUSES = {"finished", "error", "cancelled"}
+
+
+# Job history records (newest first), scanned from disk once and then kept current
+_history_cache: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+_history_loaded = False
+_history_lock = threading.Lock()
+
+
+def _history_record(task_id: str, state: Dict[str, Any], fallback_timestamp: str = "") -> Dict[str, Any]:
+    return {
+        "task_id": task_id,
+        "filename": state.get("filename", ""),
+        "original_filename": state.get("original_filename", ""),
+        "timestamp": state.get("timestamp", fallback_timestamp),
+        "runtime": state.get("runtime"),
+        "status": state.get("status", "unknown"),
+        "result_dir": state.get("result_dir", ""),
+    }
+
+
+def load_history():
+    """Scan LOGS_DIR once to populate the history cache (no-op once loaded)"""
+    global _history_loaded
+    with _history_lock:
+        if _history_loaded:
+            return
+        records = []
+        if LOGS_DIR.exists():
+            for state_file in LOGS_DIR.glob("task_*.json"):
+                try:
+                    state = orjson.loads(state_file.read_bytes())
+                    # Extract task_id from filename; file modification time is the fallback timestamp
+                    task_id = state_file.stem.replace("task_", "")
+                    timestamp = datetime.fromtimestamp(state_file.stat().st_mtime).isoformat()
+                    records.append(_history_record(task_id, state, timestamp))
+                except Exception as e:
+                    print(f"Error reading state file {state_file}: {e}")
+                    continue
+        records.sort(key=lambda r: r["timestamp"] or "", reverse=True)
+        for record in records:
+            # Tasks written before the scan finished keep their newer record
+            _history_cache.setdefault(record["task_id"], record)
+        _history_loaded = True
+
+
+def append_history(task_id: str, record: Dict[str, Any]):
+    """Insert or update a task's history record; new tasks go to the front"""
+    with _history_lock:
+        is_new = task_id not in _history_cache
+        _history_cache[task_id] = record
+        if is_new:
+            _history_cache.move_to_end(task_id, last=False)
+
+
+def list_history() -> List[Dict[str, Any]]:
+    """All job history records, newest first (shallow copy)"""
+    load_history()
+    with _history_lock:
+        return list(_history_cache.values())
+
+
+def _flush_task_state(task_id: str, state: Dict[str, Any]):
     LOGS_DIR.mkdir(parents=True, exist_ok=True)
     state_path = LOGS_DIR / f"task_{task_id}.json"
-    with open(state_path, "w", encoding="utf-8") as f:
-        json.dump(state, f, indent=2, ensure_ascii=False)
+    # Write to a temp file and rename so readers never see a half-written state
+    tmp_path = LOGS_DIR / f"task_{task_id}.json.{threading.get_ident()}.tmp"
+    # Running updates are machine-read: compact. Final states are kept human-readable.
+    option = 0 if state.get("status") == "running" else orjson.OPT_INDENT_2
+    tmp_path.write_bytes(orjson.dumps(state, option=option))
+    os.replace(tmp_path, state_path)
     return state_path
 
 
+def write_task_state(task_id: str, state: Dict[str, Any]):
+    state = dict(state)
+    now = time.time()
+    with _state_lock:
+        previous = _task_states.get(task_id)
+        # A late progress flush must never bring a cancelled / finished task back to "running"
+        if state.get("status") == "running" and (
+            task_id in _cancelled_tasks
+            or (previous is not None and previous.get("status") in _TERMINAL_STATUSES)
+        ):
+            return LOGS_DIR / f"task_{task_id}.json"
+        _task_states[task_id] = state
+        # Progress ticks leave the history record unchanged; anything else (status, runtime, ...) refreshes it
+        record = _history_record(task_id, state)
+        with _history_lock:
+            changed = _history_cache.get(task_id) != record
+        if changed:
+            append_history(task_id, record)
+        # Running updates hit disk at most once a second; status changes always do
+        if now - _last_flush.get(task_id, 0) <= _STATE_FLUSH_INTERVAL and state.get("status") == "running":
+            return LOGS_DIR / f"task_{task_id}.json"
+        _last_flush[task_id] = now
+        return _flush_task_state(task_id, state)
+
+
+def cached_task_state(task_id: str) -> Optional[Dict[str, Any]]:
+    """In-memory task state only (never touches disk); None if not cached"""
+    with _state_lock:
+        state = _task_states.get(task_id)
+    return dict(state) if state is not None else None
+
+
 def read_task_state(task_id: str) -> Optional[Dict[str, Any]]:
+    with _state_lock:
+        state = _task_states.get(task_id)
+    if state is not None:
+        return dict(state)
+
     state_path = LOGS_DIR / f"task_{task_id}.json"
     if not state_path.exists():
         return None
     try:
-        with open(state_path, "r", encoding="utf-8") as f:
-            return json.load(f)
+        state = orjson.loads(state_path.read_bytes())
     except Exception:
         return None
+    with _state_lock:
+        _task_states.setdefault(task_id, state)
+    return dict(state)
+
+
+def delete_task_state(task_id: str):
+    """Forget a task's state, in memory and on disk"""
+    with _state_lock:
+        _task_states.pop(task_id, None)
+        _last_flush.pop(task_id, None)
+        with _history_lock:
+            _history_cache.pop(task_id, None)
+        state_file = LOGS_DIR / f"task_{task_id}.json"
+        if state_file.exists():
+            state_file.unlink()
+            print(f"🗑️ Deleted task state file: {state_file}")
+
+
+def result_files(task_id: str, state: Dict[str, Any]) -> list:
+    """
+    Result file list of a finished task. Taken from the state; when missing it is
+    scanned once and memoized into the task state so later calls skip the rglob.
+    """
+    files = state.get("files")
+    if files:
+        return files
+    files = list_result_files(state["result_dir"])
+    if files:
+        write_task_state(task_id, {**state, "files": files})
+    return files
 
 
 def cancel_ocr_task(task_id: str) -> bool:
-    """Cancel a running OCR task by killing its subprocess"""
-    # Check if process is tracked
-    if task_id in _running_processes:
-        process = _running_processes[task_id]
-        try:
-            # Kill the process and its children
-            if process.poll() is None:  # Process is still running
-                process.terminate()
-                try:
-                    process.wait(timeout=5)
-                except subprocess.TimeoutExpired:
-                    process.kill()  # Force kill if terminate doesn't work
-                
-            del _running_processes[task_id]
-            
-            # Update task state
-            state = read_task_state(task_id)
-            if state:
-                state["status"] = "cancelled"
-                state["message"] = "Task was cancelled by user"
-                write_task_state(task_id, state)
-            
-            print(f"🛑 Task {task_id} cancelled")
-            return True
-        except Exception as e:
-            print(f"❌ Failed to cancel task {task_id}: {e}")
-            return False
-    
-    # Try to read PID from state file as fallback
+    """Cancel a running OCR task; the in-process job stops at its next line of output"""
+    if task_id not in _running_tasks:
+        return False
+
+    _cancelled_tasks.add(task_id)
+
+    # Update task state
     state = read_task_state(task_id)
-    if state and "pid" in state:
-        try:
-            pid = state["pid"]
-            os.kill(pid, signal.SIGTERM)
-            state["status"] = "cancelled"
-            state["message"] = "Task was cancelled by user"
-            write_task_state(task_id, state)
-            print(f"🛑 Task {task_id} cancelled via PID {pid}")
-            return True
-        except (ProcessLookupError, PermissionError) as e:
-            print(f"❌ Failed to kill process {state.get('pid')}: {e}")
-            return False
-    
-    return False
-
-
-# ====== Temporary config.py Override ======
-def override_config(model_path: str, input_path: str, output_path: str, prompt: str):
-    """Dynamically generate config.py for each task"""
-    config_lines = [
-        "# Auto-generated config for DeepSeek OCR",
-        "BASE_SIZE = 1024",
-        "IMAGE_SIZE = 640",
-        "CROP_MODE = True",
-        "MIN_CROPS = 2",
-        "MAX_CROPS = 6",
-        "MAX_CONCURRENCY = 10",
-        "NUM_WORKERS = 32",
-        "PRINT_NUM_VIS_TOKENS = False",
-        "SKIP_REPEAT = True",
-        "",
-        f"MODEL_PATH = r'{model_path}'",
-        f"INPUT_PATH = r'{input_path}'",
-        f"OUTPUT_PATH = r'{output_path}'",
-        f'PROMPT = """{prompt}"""',
-        "",
-        "from transformers import AutoTokenizer",
-        "TOKENIZER = AutoTokenizer.from_pretrained(MODEL_PATH, trust_remote_code=True)",
-    ]
-    CONFIG_PATH.write_text("\n".join(config_lines), encoding="utf-8")
-    print(f"✅ Temporary config.py override successful: {CONFIG_PATH}")
+    if state:
+        state["status"] = "cancelled"
+        state["message"] = "Task was cancelled by user"
+        write_task_state(task_id, state)
+
+    print(f"🛑 Task {task_id} cancelled")
+    return True
 
 
 # ====== Core Task Execution ======
-def run_ocr_task(
+async def run_ocr_task(
     input_path: str,
     task_id: str,
     on_progress: Optional[Callable[[int], None]] = None,
@@ -145,7 +229,11 @@ def run_ocr_task(
     original_filename: str = "",
     on_console_log: Optional[Callable[[str], None]] = None
 ) -> Dict[str, Any]:
-    """Execute OCR task"""
+    """
+    Execute OCR task.
+    A coroutine: it awaits the GPU worker's future, so a task waiting in the
+    queue does not hold an executor thread.
+    """
     start_time = time.time()
     timestamp = datetime.now().isoformat()
     
@@ -161,70 +249,21 @@ def run_ocr_task(
         })
 
         file_type = detect_file_type(input_path)
-        script_path = PDF_SCRIPT if file_type == "pdf" else IMAGE_SCRIPT
-
-        override_config(MODEL_PATH, input_path, str(result_dir), prompt)
 
         print(f"🚀 Starting DeepSeek OCR task ({file_type.upper()})")
-        print(f"📄 Using script: {script_path}")
         print(f"📁 Output path: {result_dir}")
 
-        command = ["python", str(script_path)]
-
-        process = subprocess.Popen(
-            command,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT,
-            universal_newlines=True,
-            bufsize=1,
-        )
-        
-        # Track the process for cancellation
-        _running_processes[task_id] = process
-        
-        # Store PID in task state for recovery
-        write_task_state(task_id, {
-            "status": "running", 
-            "result_dir": str(result_dir),
-            "filename": filename,
-            "original_filename": original_filename,
-            "timestamp": timestamp,
-            "start_time": start_time,
-            "pid": process.pid
-        })
-
         progress = 0
         console_buffer = []
+        progress_dirty = threading.Event()
+        flush_stop = threading.Event()
 
-        def _read_output():
-            nonlocal progress
-            for line in process.stdout:
-                line = line.strip()
-                
-                # Store console output
-                console_buffer.append(line)
-                
-                # Send to console WebSocket if callback provided
-                if on_console_log:
-                    try:
-                        on_console_log(line)
-                    except Exception:
-                        pass
-
-                # Estimate progress based on log keywords
-                if "loading" in line.lower():
-                    progress = 10
-                elif "pre-processed" in line.lower():
-                    progress = 30
-                elif "generate" in line.lower():
-                    progress = 60
-                elif "save results" in line.lower():
-                    progress = 90
-                elif "result_with_boxes" in line.lower() or "complete" in line.lower():
-                    progress = 100
-
-                # Write progress to task state file on each update
-                elapsed = int(time.time() - start_time)
+        def _flush_progress():
+            # Coalesce progress updates into at most one state write every 500ms
+            while not flush_stop.wait(0.5):
+                if not progress_dirty.is_set() or task_id in _cancelled_tasks:
+                    continue
+                progress_dirty.clear()
                 write_task_state(task_id, {
                     "status": "running",
                     "result_dir": str(result_dir),
@@ -232,33 +271,79 @@ def run_ocr_task(
                     "filename": filename,
                     "original_filename": original_filename,
                     "timestamp": timestamp,
-                    "elapsed": elapsed
+                    "elapsed": int(time.time() - start_time)
                 })
 
-                if on_progress:
-                    on_progress(progress)
+        def _handle_line(line):
+            nonlocal progress
+            line = line.strip()
+            
+            # Store console output
+            console_buffer.append(line)
+            
+            # Send to console WebSocket if callback provided
+            if on_console_log:
+                try:
+                    on_console_log(line)
+                except Exception:
+                    pass
 
-                print(line)
+            # Estimate progress based on log keywords (never moves backwards)
+            match = _PROGRESS_RE.search(line)
+            if match:
+                new_progress = _PROGRESS_MAP[match.group(1).lower()]
+                if new_progress > progress:
+                    progress = new_progress
+                    # Mark progress for the background flush
+                    progress_dirty.set()
 
-        thread = threading.Thread(target=_read_output)
-        thread.start()
-        process.wait()
-        thread.join()
-        
-        # Clean up process tracking
-        if task_id in _running_processes:
-            del _running_processes[task_id]
+            if on_progress:
+                try:
+                    on_progress(progress)
+                except Exception as e:
+                    # Straight to the real stderr: this runs on the GPU thread, whose print() comes back here
+                    sys.__stderr__.write(f"⚠️ Progress callback failed for task {task_id}: {e}\n")
+
+        flush_thread = threading.Thread(target=_flush_progress, daemon=True)
+        flush_thread.start()
+        _running_tasks.add(task_id)
+        try:
+            # Queued for the GPU thread (resident model); resumes once this job has run
+            returncode = await asyncio.wrap_future(ocr_worker.submit(
+                input_path,
+                str(result_dir),
+                prompt,
+                on_line=_handle_line,
+                is_cancelled=lambda: task_id in _cancelled_tasks,
+            ))
+        except ocr_worker.TaskCancelled:
+            returncode = None
+        finally:
+            flush_stop.set()
+            flush_thread.join()
+            _running_tasks.discard(task_id)
 
         # Calculate total runtime
         runtime = int(time.time() - start_time)
         
         # Check if task was cancelled
         current_state = read_task_state(task_id)
-        if current_state and current_state.get("status") == "cancelled":
+        if task_id in _cancelled_tasks or (current_state and current_state.get("status") == "cancelled"):
+            # Record the terminal state here too, whatever the cancel request managed to write
+            write_task_state(task_id, {
+                "status": "cancelled",
+                "message": "Task was cancelled by user",
+                "result_dir": str(result_dir),
+                "filename": filename,
+                "original_filename": original_filename,
+                "timestamp": timestamp,
+                "runtime": runtime
+            })
+            _cancelled_tasks.discard(task_id)
             print(f"🛑 Task {task_id} was cancelled")
             return {"status": "cancelled", "message": "Task was cancelled by user", "runtime": runtime}
 
-        if process.returncode != 0:
+        if returncode != 0:
             write_task_state(task_id, {
                 "status": "error", 
                 "message": "DeepSeek OCR execution failed",
@@ -269,7 +354,7 @@ def run_ocr_task(
             })
             raise RuntimeError("DeepSeek OCR execution failed")
 
-        files = list_result_files(result_dir)
+        files = await asyncio.to_thread(list_result_files, result_dir)
         write_task_state(task_id, {
             "status": "finished", 
             "result_dir": str(result_dir), 
@@ -290,10 +375,6 @@ def run_ocr_task(
         }
 
     except Exception as e:
-        # Clean up process tracking
-        if task_id in _running_processes:
-            del _running_processes[task_id]
-            
         runtime = int(time.time() - start_time)
         write_task_state(task_id, {
             "status": "error", 
@@ -9,19 +9,42 @@ import asyncio
 import zipfile
 import io
 import os
-import json
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from datetime import datetime
+import aiofiles
+import orjson
 from fastapi import FastAPI, UploadFile, File, WebSocket, WebSocketDisconnect, BackgroundTasks
 from fastapi.responses import FileResponse, JSONResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
 from fastapi import Query
 
+import ocr_worker
 from file_manager import save_uploaded_file
-from inference_runner import run_ocr_task, read_task_state, cancel_ocr_task, LOGS_DIR
+from inference_runner import run_ocr_task, read_task_state, cached_task_state, delete_task_state, cancel_ocr_task, load_history, list_history, result_files
 from config_loader import UPLOAD_DIR, RESULTS_DIR
 
+
+def dumps_json(payload) -> str:
+    # Text frames (the frontend JSON.parses event.data), serialized by orjson
+    return orjson.dumps(payload).decode("utf-8")
+
+
+# Small dedicated pool for cold (on-disk) task-state reads, independent of the default executor
+_state_io = ThreadPoolExecutor(max_workers=2, thread_name_prefix="task-state-io")
+
+
+async def get_task_state(task_id: str):
+    """Task state from memory; only cold reads go to disk, on the dedicated pool"""
+    state = cached_task_state(task_id)
+    if state is None:
+        state = await asyncio.get_running_loop().run_in_executor(_state_io, read_task_state, task_id)
+    return state
+
+
 # Track running task processes for cancellation
 running_tasks: dict = {}
 
@@ -40,24 +63,128 @@ active_connections = {}
 console_connections = {}
 
 
+@app.on_event("startup")
+async def load_job_history():
+    """Scan task state files once; /api/history is served from memory afterwards"""
+    await asyncio.to_thread(load_history)
+
+
+@app.on_event("startup")
+async def load_ocr_model():
+    """Load the DeepSeek OCR model once so tasks don't pay the cold start"""
+    try:
+        await asyncio.to_thread(ocr_worker.load_model)
+    except Exception as e:
+        # The first task retries the load
+        print(f"⚠️ Failed to preload OCR model: {e}")
+
+
 async def send_progress(websocket: WebSocket, task_id: str, percent: int):
     """WebSocket real-time progress"""
     try:
-        await websocket.send_json({"task_id": task_id, "progress": percent})
+        await websocket.send_text(dumps_json({"task_id": task_id, "progress": percent}))
     except Exception:
         pass
 
 
-async def send_console_log(task_id: str, message: str):
-    """Send console log to connected WebSocket clients"""
+async def send_console_logs(task_id: str, lines: list):
+    """Send a batch of console log lines to connected WebSocket clients"""
     if task_id in console_connections:
         try:
             ws = console_connections[task_id]
-            await ws.send_json({"type": "log", "content": message})
+            await ws.send_text(dumps_json({"type": "log_batch", "lines": lines}))
         except Exception:
             pass
 
 
+async def flush_console_logs(task_id: str, log_buffer: list, stop: asyncio.Event):
+    """Flush buffered console lines every 50ms (one frame per batch instead of per line)"""
+    while True:
+        try:
+            await asyncio.wait_for(stop.wait(), timeout=0.05)
+        except asyncio.TimeoutError:
+            pass
+        if log_buffer:
+            lines = log_buffer[:]
+            del log_buffer[:]
+            await send_console_logs(task_id, lines)
+        if stop.is_set():
+            break
+
+
+class _QueueWriter(io.RawIOBase):
+    """Write-only stream that hands every chunk to a bounded queue (feeds the streaming ZIP download)"""
+
+    def __init__(self, chunks: queue.Queue, aborted: threading.Event):
+        self.chunks = chunks
+        self.aborted = aborted
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        data = bytes(b)
+        _put_until_aborted(self.chunks, data, self.aborted)
+        return len(data)
+
+
+def _put_until_aborted(chunks: queue.Queue, item, aborted: threading.Event):
+    # Blocks while the client is slow, gives up once it has gone away
+    while True:
+        if aborted.is_set():
+            raise OSError("ZIP download aborted by client")
+        try:
+            chunks.put(item, timeout=0.5)
+            return
+        except queue.Full:
+            continue
+
+
+_ZIP_DONE = object()
+
+# Already entropy-coded formats: DEFLATE only burns CPU on them
+_STORED_SUFFIXES = {".png", ".jpg", ".jpeg", ".webp"}
+
+
+def stream_zip(add_entries):
+    """
+    Build a ZIP on a background thread and yield its bytes as they are produced.
+    add_entries(zip_file) writes the archive members; memory stays bounded by the chunk queue.
+    """
+    chunks: queue.Queue = queue.Queue(maxsize=16)
+    aborted = threading.Event()
+
+    def _produce():
+        result = _ZIP_DONE
+        try:
+            # The buffer coalesces zipfile's many small header writes into 64 KiB chunks
+            with io.BufferedWriter(_QueueWriter(chunks, aborted), buffer_size=1 << 16) as stream:
+                with zipfile.ZipFile(stream, "w", zipfile.ZIP_DEFLATED) as zip_file:
+                    add_entries(zip_file)
+        except Exception as e:
+            if aborted.is_set():
+                return
+            print(f"❌ Error building ZIP: {e}")
+            result = e
+        try:
+            _put_until_aborted(chunks, result, aborted)
+        except OSError:
+            pass
+
+    producer = threading.Thread(target=_produce, daemon=True)
+    producer.start()
+    try:
+        while True:
+            chunk = chunks.get()
+            if chunk is _ZIP_DONE:
+                break
+            if isinstance(chunk, Exception):
+                raise chunk
+            yield chunk
+    finally:
+        aborted.set()
+
+
 @app.get("/api/folder")
 async def get_folder_structure(path: str = Query(..., description="Result folder path")):
     """Recursively return folder structure (including subfolders)"""
@@ -65,28 +192,37 @@ async def get_folder_structure(path: str = Query(..., description="Result folder
     if not base_path.exists() or not base_path.is_dir():
         return {"status": "error", "message": f"Invalid path: {path}"}
 
-    def build_tree(directory: Path):
-        items = []
-        for entry in sorted(directory.iterdir(), key=lambda e: (e.is_file(), e.name.lower())):
-            if entry.is_dir():
-                items.append({
-                    "name": entry.name,
-                    "type": "folder",
-                    "path": str(entry),
-                    "children": build_tree(entry)
-                })
-            else:
-                items.append({
-                    "name": entry.name,
-                    "type": "file",
-                    "path": str(entry)
-                })
-        return items
+    def build_tree(directory: str):
+        # os.scandir gives the file type from the directory listing itself: no extra stat() per entry.
+        # Walk with an explicit stack so deep trees can't hit the recursion limit.
+        root = []
+        stack = [(directory, root)]
+        while stack:
+            current, items = stack.pop()
+            with os.scandir(current) as it:
+                entries = sorted(it, key=lambda e: (e.is_file(), e.name.lower()))
+            for entry in entries:
+                if entry.is_dir():
+                    children = []
+                    items.append({
+                        "name": entry.name,
+                        "type": "folder",
+                        "path": entry.path,
+                        "children": children
+                    })
+                    stack.append((entry.path, children))
+                else:
+                    items.append({
+                        "name": entry.name,
+                        "type": "file",
+                        "path": entry.path
+                    })
+        return root
 
     return {
         "status": "success",
         "path": str(base_path),
-        "children": build_tree(base_path)
+        "children": build_tree(str(base_path))
     }
 
 
@@ -120,27 +256,44 @@ async def start_ocr_task_endpoint(payload: dict, background_tasks: BackgroundTas
     filename = Path(file_path).name
 
     async def background_task():
+        # The callbacks run on the GPU worker thread: hand the sends to the event loop
+        loop = asyncio.get_running_loop()
+        last_sent = {"progress": None, "time": 0.0}
+
         def on_progress(p):
+            # Coalesce: only send when progress changes or at most every 100ms
+            now = time.monotonic()
+            if p == last_sent["progress"] and now - last_sent["time"] < 0.1:
+                return
             if task_id in active_connections:
+                last_sent["progress"], last_sent["time"] = p, now
                 ws = active_connections[task_id]
-                asyncio.create_task(send_progress(ws, task_id, p))
+                asyncio.run_coroutine_threadsafe(send_progress(ws, task_id, p), loop)
+
+        log_buffer = []
+        log_stop = asyncio.Event()
+        log_flusher = asyncio.create_task(flush_console_logs(task_id, log_buffer, log_stop))
 
         def on_console_log(msg):
             if task_id in console_connections:
-                asyncio.create_task(send_console_log(task_id, msg))
-
-        # Use asyncio.to_thread to run blocking OCR task without blocking event loop
-        # This allows other API calls (like /api/history) to respond during processing
-        result = await asyncio.to_thread(
-            run_ocr_task,
-            input_path=file_path, 
-            task_id=task_id, 
-            on_progress=on_progress, 
-            prompt=prompt,
-            filename=filename,
-            original_filename=original_filename,
-            on_console_log=on_console_log
-        )
+                loop.call_soon_threadsafe(log_buffer.append, msg)
+
+        # run_ocr_task awaits the GPU worker's future: no thread is blocked while the job
+        # waits in the queue, and other API calls (like /api/history) keep responding
+        try:
+            result = await run_ocr_task(
+                input_path=file_path, 
+                task_id=task_id, 
+                on_progress=on_progress, 
+                prompt=prompt,
+                filename=filename,
+                original_filename=original_filename,
+                on_console_log=on_console_log
+            )
+        finally:
+            # Deliver the last buffered lines before the result
+            log_stop.set()
+            await log_flusher
         
         # Clean up running task reference
         if task_id in running_tasks:
@@ -148,7 +301,7 @@ async def start_ocr_task_endpoint(payload: dict, background_tasks: BackgroundTas
 
         if task_id in active_connections:
             ws = active_connections[task_id]
-            asyncio.create_task(ws.send_json(result))
+            asyncio.create_task(ws.send_text(dumps_json(result)))
 
     background_tasks.add_task(background_task)
     return {"status": "running", "task_id": task_id}
@@ -187,7 +340,7 @@ async def websocket_console(websocket: WebSocket, task_id: str):
 @app.get("/api/result/{task_id}")
 async def get_result_files(task_id: str):
     """Get result files"""
-    state = read_task_state(task_id)
+    state = await get_task_state(task_id)
     if not state:
         return {"status": "error", "message": "Task does not exist or state file is missing"}
 
@@ -203,11 +356,7 @@ async def get_result_files(task_id: str):
     if not result_dir.exists():
         return {"status": "error", "message": "Result directory does not exist"}
 
-    files = state.get("files", [])
-    if not files:
-        for path in result_dir.rglob("*"):
-            if path.is_file():
-                files.append(str(path.relative_to(result_dir)))
+    files = await asyncio.get_running_loop().run_in_executor(_state_io, result_files, task_id, state)
 
     return {
         "status": "success",
@@ -222,7 +371,7 @@ async def get_result_files(task_id: str):
 @app.get("/api/progress/{task_id}")
 async def get_task_progress(task_id: str):
     """Query task real-time progress"""
-    state = read_task_state(task_id)
+    state = await get_task_state(task_id)
     if not state:
         return {"status": "error", "message": "Task does not exist or state file is missing"}
 
@@ -247,50 +396,22 @@ async def preview_file(path: str):
     if file_path.suffix.lower() in [".png", ".jpg", ".jpeg"]:
         return FileResponse(file_path)
     else:
-        content = file_path.read_text(encoding="utf-8", errors="ignore")
+        # Read without blocking the event loop (OCR output can be megabytes)
+        async with aiofiles.open(file_path, "r", encoding="utf-8", errors="ignore") as f:
+            content = await f.read()
         return JSONResponse({"content": content})
 
 
 @app.get("/api/history")
 async def get_job_history():
     """Get all completed job history"""
-    jobs = []
-    
-    if not LOGS_DIR.exists():
-        return {"status": "success", "jobs": []}
-    
-    # Read all task state files
-    for state_file in sorted(LOGS_DIR.glob("task_*.json"), reverse=True):
-        try:
-            with open(state_file, "r", encoding="utf-8") as f:
-                state = json.load(f)
-            
-            # Extract task_id from filename
-            task_id = state_file.stem.replace("task_", "")
-            
-            # Get file modification time as timestamp
-            timestamp = datetime.fromtimestamp(state_file.stat().st_mtime).isoformat()
-            
-            jobs.append({
-                "task_id": task_id,
-                "filename": state.get("filename", ""),
-                "original_filename": state.get("original_filename", ""),
-                "timestamp": state.get("timestamp", timestamp),
-                "runtime": state.get("runtime"),
-                "status": state.get("status", "unknown"),
-                "result_dir": state.get("result_dir", ""),
-            })
-        except Exception as e:
-            print(f"Error reading state file {state_file}: {e}")
-            continue
-    
-    return {"status": "success", "jobs": jobs}
+    return {"status": "success", "jobs": list_history()}
 
 
 @app.post("/api/cancel/{task_id}")
 async def cancel_task(task_id: str):
     """Cancel a running OCR task"""
-    state = read_task_state(task_id)
+    state = await get_task_state(task_id)
     if not state:
         return {"status": "error", "message": "Task does not exist"}
     
@@ -311,7 +432,7 @@ async def delete_task(task_id: str):
     """Delete a task and its result files"""
     import shutil
     
-    state = read_task_state(task_id)
+    state = await get_task_state(task_id)
     if not state:
         return {"status": "error", "message": "Task does not exist"}
     
@@ -328,11 +449,8 @@ async def delete_task(task_id: str):
                 shutil.rmtree(result_path)
                 print(f"🗑️ Deleted result directory: {result_path}")
         
-        # Delete task state file
-        state_file = LOGS_DIR / f"task_{task_id}.json"
-        if state_file.exists():
-            state_file.unlink()
-            print(f"🗑️ Deleted task state file: {state_file}")
+        # Delete task state (in memory and on disk)
+        delete_task_state(task_id)
         
         return {"status": "success", "message": f"Task {task_id} deleted"}
     except Exception as e:
@@ -343,7 +461,7 @@ async def delete_task(task_id: str):
 @app.get("/api/download/zip/{task_id}")
 async def download_zip(task_id: str, format: str = Query("mmd", description="Output format: mmd, md, or txt")):
     """Download all result files as a ZIP archive with format conversion"""
-    state = read_task_state(task_id)
+    state = await get_task_state(task_id)
     if not state:
         return {"status": "error", "message": "Task does not exist"}
     
@@ -358,14 +476,12 @@ async def download_zip(task_id: str, format: str = Query("mmd", description="Out
     if format not in ["mmd", "md", "txt"]:
         format = "mmd"
     
-    # Create ZIP in memory
-    zip_buffer = io.BytesIO()
-    
-    with zipfile.ZipFile(zip_buffer, "w", zipfile.ZIP_DEFLATED) as zip_file:
+    def add_entries(zip_file: zipfile.ZipFile):
         for file_path in result_dir.rglob("*"):
             if file_path.is_file():
                 # Get relative path
                 rel_path = file_path.relative_to(result_dir)
+                compress_type = zipfile.ZIP_STORED if file_path.suffix.lower() in _STORED_SUFFIXES else zipfile.ZIP_DEFLATED
                 
                 # Convert .mmd files to requested format
                 if file_path.suffix.lower() == ".mmd" and format != "mmd":
@@ -376,15 +492,14 @@ async def download_zip(task_id: str, format: str = Query("mmd", description="Out
                     new_name = str(rel_path).replace(".mmd", f".{format}")
                     
                     # Write to zip with new name
-                    zip_file.writestr(new_name, content)
+                    zip_file.writestr(new_name, content, compress_type=compress_type)
                 else:
                     # Add file as-is
-                    zip_file.write(file_path, rel_path)
-    
-    zip_buffer.seek(0)
+                    zip_file.write(file_path, rel_path, compress_type=compress_type)
     
+    # Stream the archive while it is being built instead of buffering it in memory
     return StreamingResponse(
-        zip_buffer,
+        stream_zip(add_entries),
         media_type="application/zip",
         headers={
             "Content-Disposition": f"attachment; filename=ocr_results_{task_id}.zip"
@@ -397,4 +512,5 @@ app.mount("/results", StaticFiles(directory=str(RESULTS_DIR)), name="results")
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8002)
+    # libuv event loop + C HTTP parser (uvicorn[standard])
+    uvicorn.run(app, host="0.0.0.0", port=8002, loop="uvloop", http="httptools", ws="websockets")
@@ -0,0 +1,199 @@
+"""
+ocr_worker.py
+-------------
+In-process DeepSeek OCR worker.
+- Loads the model / tokenizer once (at server startup) and keeps them resident
+- A dedicated GPU thread serves PDF / image jobs from a queue; infer() submits and waits
+- Forwards the job's console output to a callback line by line
+- Cooperative cancellation: the running job stops at its next line of output
+"""
+
+import queue
+import re
+import sys
+import threading
+import traceback
+from concurrent.futures import Future
+from typing import Callable, Optional
+
+from config_loader import MODEL_PATH
+from file_manager import detect_file_type
+
+# Same line splitting as a universal_newlines pipe (tqdm redraws with \r)
+_LINE_SPLIT_RE = re.compile(r"\r\n|\r|\n")
+
+_model = None
+_tokenizer = None
+_run_image_ocr = None
+_run_pdf_ocr = None
+_load_lock = threading.Lock()
+
+# Jobs for the GPU thread, the only thread that runs the model
+_jobs: "queue.Queue[tuple]" = queue.Queue()
+_gpu_thread: Optional[threading.Thread] = None
+_gpu_thread_lock = threading.Lock()
+
+# Per-thread output sink, set on the GPU thread while it runs a job
+_capture = threading.local()
+
+
+class TaskCancelled(BaseException):
+    """Raised inside a running job to abort it (BaseException so the OCR scripts' `except Exception` can't swallow it)"""
+
+
+class _LineSink:
+    """File-like object that forwards complete lines to a callback and echoes them to the server console"""
+
+    def __init__(self, on_line: Callable[[str], None], echo):
+        self.on_line = on_line
+        self.echo = echo
+        self._buffer = ""
+
+    def write(self, text):
+        self._buffer += text
+        *lines, self._buffer = _LINE_SPLIT_RE.split(self._buffer)
+        for line in lines:
+            self._emit(line)
+        return len(text)
+
+    def flush(self):
+        # Streamers print(token, end="", flush=True): a flush is not a line boundary
+        pass
+
+    def close(self):
+        """Emit the trailing partial line, once, when the job ends"""
+        if self._buffer:
+            line, self._buffer = self._buffer, ""
+            self._emit(line)
+
+    def _emit(self, line):
+        self.echo.write(line + "\n")
+        self.on_line(line)
+
+
+class _ThreadRoutedStream:
+    """
+    sys.stdout / sys.stderr proxy: output from the GPU thread goes to the running
+    job's sink, everything else (other requests, uvicorn) passes through unchanged.
+    """
+
+    def __init__(self, stream):
+        self._stream = stream
+
+    def write(self, text):
+        sink = getattr(_capture, "sink", None)
+        if sink is None:
+            return self._stream.write(text)
+        return sink.write(text)
+
+    def flush(self):
+        # The sink only forwards complete lines (see _LineSink.flush), so just flush the real stream
+        self._stream.flush()
+
+    def isatty(self):
+        if getattr(_capture, "sink", None) is not None:
+            return False
+        return self._stream.isatty()
+
+    def __getattr__(self, name):
+        return getattr(self._stream, name)
+
+
+def _install_output_routing():
+    if not isinstance(sys.stdout, _ThreadRoutedStream):
+        sys.stdout = _ThreadRoutedStream(sys.stdout)
+    if not isinstance(sys.stderr, _ThreadRoutedStream):
+        sys.stderr = _ThreadRoutedStream(sys.stderr)
+
+
+def load_model(model_path: str = MODEL_PATH):
+    """Load the model / tokenizer once; later calls return the resident instances"""
+    global _model, _tokenizer, _run_image_ocr, _run_pdf_ocr
+    with _load_lock:
+        if _model is None:
+            # Import both OCR scripts (torch, transformers, fitz) up front so the
+            # first task of either type doesn't pay for it
+            from run_dpsk_ocr_image_hf import load_model as _load, run_image_ocr
+            from run_dpsk_ocr_pdf_hf import run_pdf_ocr
+            _run_image_ocr, _run_pdf_ocr = run_image_ocr, run_pdf_ocr
+            _model, _tokenizer = _load(model_path)
+    return _model, _tokenizer
+
+
+def _run_job(input_path, output_path, prompt, on_line, is_cancelled) -> int:
+    """Run one OCR job on the GPU thread with its output routed to on_line"""
+    def _on_line(line):
+        if is_cancelled and is_cancelled():
+            raise TaskCancelled()
+        if on_line:
+            on_line(line)
+
+    sink = _LineSink(_on_line, sys.__stdout__)
+    _capture.sink = sink
+    try:
+        if is_cancelled and is_cancelled():
+            raise TaskCancelled()
+        try:
+            model, tokenizer = load_model()
+            if detect_file_type(input_path) == "pdf":
+                _run_pdf_ocr(model, tokenizer, input_path, output_path, prompt)
+            else:
+                _run_image_ocr(model, tokenizer, input_path, output_path, prompt)
+        except Exception:
+            traceback.print_exc()
+            return 1
+        finally:
+            sink.close()
+        return 0
+    finally:
+        _capture.sink = None
+
+
+def _gpu_worker():
+    # Jobs run back to back in submission order while the model stays hot
+    # (model.infer() takes a single image, so there is nothing to batch per call)
+    while True:
+        job, future = _jobs.get()
+        if not future.set_running_or_notify_cancel():
+            continue
+        try:
+            future.set_result(_run_job(*job))
+        except BaseException as e:
+            future.set_exception(e)
+
+
+def _ensure_gpu_thread():
+    global _gpu_thread
+    with _gpu_thread_lock:
+        if _gpu_thread is None or not _gpu_thread.is_alive():
+            _gpu_thread = threading.Thread(target=_gpu_worker, name="ocr-gpu-worker", daemon=True)
+            _gpu_thread.start()
+
+
+def submit(
+    input_path: str,
+    output_path: str,
+    prompt: str,
+    on_line: Optional[Callable[[str], None]] = None,
+    is_cancelled: Optional[Callable[[], bool]] = None,
+) -> Future:
+    """Queue one OCR job for the GPU thread; the future resolves to 0 / 1 or raises TaskCancelled"""
+    _install_output_routing()
+    _ensure_gpu_thread()
+    future: Future = Future()
+    _jobs.put(((input_path, output_path, prompt, on_line, is_cancelled), future))
+    return future
+
+
+def infer(
+    input_path: str,
+    output_path: str,
+    prompt: str,
+    on_line: Optional[Callable[[str], None]] = None,
+    is_cancelled: Optional[Callable[[], bool]] = None,
+) -> int:
+    """
+    Run one OCR job with the resident model, blocking until it finishes.
+    Returns 0 on success, 1 on failure; raises TaskCancelled if is_cancelled() turns true.
+    """
+    return submit(input_path, output_path, prompt, on_line, is_cancelled).result()
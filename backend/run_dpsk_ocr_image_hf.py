@@ -18,7 +18,6 @@ import torch
 torch._dynamo.config.suppress_errors = True
 
 from transformers import AutoModel, AutoTokenizer
-from config import MODEL_PATH, INPUT_PATH, OUTPUT_PATH, PROMPT
 
 
 class Colors:
@@ -29,19 +28,22 @@ class Colors:
     RESET = '\033[0m'
 
 
-# Initialize model globally using official method
-print(f'{Colors.BLUE}Loading DeepSeek OCR model (Hugging Face Transformers)...{Colors.RESET}')
-tokenizer = AutoTokenizer.from_pretrained(MODEL_PATH, trust_remote_code=True)
-model = AutoModel.from_pretrained(MODEL_PATH, trust_remote_code=True, use_safetensors=True)
-model = model.eval().cuda().to(torch.bfloat16)
-print(f'{Colors.GREEN}✅ Model loaded successfully!{Colors.RESET}')
+def load_model(model_path):
+    """Initialize model using official method"""
+    print(f'{Colors.BLUE}Loading DeepSeek OCR model (Hugging Face Transformers)...{Colors.RESET}')
+    tokenizer = AutoTokenizer.from_pretrained(model_path, trust_remote_code=True)
+    model = AutoModel.from_pretrained(model_path, trust_remote_code=True, use_safetensors=True)
+    model = model.eval().cuda().to(torch.bfloat16)
+    print(f'{Colors.GREEN}✅ Model loaded successfully!{Colors.RESET}')
+    return model, tokenizer
 
 
-if __name__ == "__main__":
-    os.makedirs(OUTPUT_PATH, exist_ok=True)
-    os.makedirs(f'{OUTPUT_PATH}/images', exist_ok=True)
+def run_image_ocr(model, tokenizer, input_path, output_path, prompt):
+    """Run OCR on a single image and save results to output_path"""
+    os.makedirs(output_path, exist_ok=True)
+    os.makedirs(f'{output_path}/images', exist_ok=True)
     
-    print(f'{Colors.RED}Loading image: {INPUT_PATH}{Colors.RESET}')
+    print(f'{Colors.RED}Loading image: {input_path}{Colors.RESET}')
     
     # Run inference using official method
     print(f'{Colors.GREEN}Running OCR inference...{Colors.RESET}')
@@ -49,9 +51,9 @@ if __name__ == "__main__":
     try:
         result = model.infer(
             tokenizer,
-            prompt=PROMPT,
-            image_file=INPUT_PATH,
-            output_path=OUTPUT_PATH,
+            prompt=prompt,
+            image_file=input_path,
+            output_path=output_path,
             base_size=1024,
             image_size=640,
             crop_mode=True,
@@ -59,9 +61,16 @@ if __name__ == "__main__":
             test_compress=False
         )
         
-        print(f'{Colors.GREEN}✅ OCR complete! Results saved to {OUTPUT_PATH}{Colors.RESET}')
+        print(f'{Colors.GREEN}✅ OCR complete! Results saved to {output_path}{Colors.RESET}')
         
     except Exception as e:
         print(f"{Colors.RED}Error: {e}{Colors.RESET}")
         import traceback
         traceback.print_exc()
+
+
+if __name__ == "__main__":
+    from config import MODEL_PATH, INPUT_PATH, OUTPUT_PATH, PROMPT
+    
+    model, tokenizer = load_model(MODEL_PATH)
+    run_image_ocr(model, tokenizer, INPUT_PATH, OUTPUT_PATH, PROMPT)
@@ -78,16 +78,9 @@ def pdf_to_images_high_quality(pdf_path, dpi=144, image_format="PNG"):
         pixmap = page.get_pixmap(matrix=matrix, alpha=False)
         Image.MAX_IMAGE_PIXELS = None
 
-        if image_format.upper() == "PNG":
-            img_data = pixmap.tobytes("png")
-            img = Image.open(io.BytesIO(img_data))
-        else:
-            img_data = pixmap.tobytes("png")
-            img = Image.open(io.BytesIO(img_data))
-            if img.mode in ('RGBA', 'LA'):
-                background = Image.new('RGB', img.size, (255, 255, 255))
-                background.paste(img, mask=img.split()[-1] if img.mode == 'RGBA' else None)
-                img = background
+        # alpha=False gives packed RGB samples: wrap them directly instead of a PNG encode + decode
+        # (same result for either image_format)
+        img = Image.frombuffer("RGB", (pixmap.width, pixmap.height), pixmap.samples, "raw", "RGB", pixmap.stride, 1)
         
         images.append(img)
     
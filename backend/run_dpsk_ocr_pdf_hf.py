@@ -13,16 +13,27 @@ os.environ["PYTORCH_JIT"] = "0"
 os.environ["CUDA_VISIBLE_DEVICES"] = '0'
 
 import fitz
-import io
+import math
+import shutil
+import tempfile
 import torch
 from tqdm import tqdm
-from PIL import Image
 
 # Suppress dynamo errors
 torch._dynamo.config.suppress_errors = True
 
 from transformers import AutoModel, AutoTokenizer
-from config import MODEL_PATH, INPUT_PATH, OUTPUT_PATH, PROMPT
+
+
+# model.infer() only accepts an image path, so keep the rendered pages on tmpfs (RAM) when available
+PAGE_TMP_DIR = '/dev/shm' if os.path.isdir('/dev/shm') and os.access('/dev/shm', os.W_OK) else None
+
+
+# model.infer() preprocessing settings (also used to size the rendered pages)
+BASE_SIZE = 1024
+IMAGE_SIZE = 640
+CROP_MODE = True
+MAX_CROPS = 6
 
 
 class Colors:
@@ -33,119 +44,91 @@ class Colors:
     RESET = '\033[0m'
 
 
-# Initialize model globally using official method
-print(f'{Colors.BLUE}Loading DeepSeek OCR model (Hugging Face Transformers)...{Colors.RESET}')
-tokenizer = AutoTokenizer.from_pretrained(MODEL_PATH, trust_remote_code=True)
-model = AutoModel.from_pretrained(MODEL_PATH, trust_remote_code=True, use_safetensors=True)
-model = model.eval().cuda().to(torch.bfloat16)
-print(f'{Colors.GREEN}✅ Model loaded successfully!{Colors.RESET}')
+def load_model(model_path):
+    """Initialize model using official method"""
+    print(f'{Colors.BLUE}Loading DeepSeek OCR model (Hugging Face Transformers)...{Colors.RESET}')
+    tokenizer = AutoTokenizer.from_pretrained(model_path, trust_remote_code=True)
+    model = AutoModel.from_pretrained(model_path, trust_remote_code=True, use_safetensors=True)
+    model = model.eval().cuda().to(torch.bfloat16)
+    print(f'{Colors.GREEN}✅ Model loaded successfully!{Colors.RESET}')
+    return model, tokenizer
 
 
-def pdf_to_images_high_quality(pdf_path, dpi=144):
-    """Convert PDF to high-quality images."""
-    images = []
-    pdf_document = fitz.open(pdf_path)
-    
-    zoom = dpi / 72.0
-    matrix = fitz.Matrix(zoom, zoom)
-    
-    for page_num in range(pdf_document.page_count):
-        page = pdf_document[page_num]
-        pixmap = page.get_pixmap(matrix=matrix, alpha=False)
-        Image.MAX_IMAGE_PIXELS = None
-        img_data = pixmap.tobytes("png")
-        img = Image.open(io.BytesIO(img_data))
-        images.append(img)
-    
-    pdf_document.close()
-    return images
+def page_dpi(page, min_dpi=96, max_dpi=144):
+    """
+    DPI that makes the page's longer edge about the size the model resizes it to anyway:
+    BASE_SIZE for the single global view, or the longest side of the IMAGE_SIZE crop grid in crop mode.
+    Capped at the previous fixed 144 dpi, so standard pages (A4 / Letter) never get more pixels;
+    only oversized pages, or any page without crop mode, are rendered smaller.
+    """
+    target_px = BASE_SIZE
+    if CROP_MODE:
+        target_px = max(BASE_SIZE, IMAGE_SIZE * math.ceil(math.sqrt(MAX_CROPS)))
+    longest_pts = max(page.rect.width, page.rect.height) or 72
+    return min(max(72 * target_px / longest_pts, min_dpi), max_dpi)
 
 
-if __name__ == "__main__":
-    os.makedirs(OUTPUT_PATH, exist_ok=True)
-    os.makedirs(f'{OUTPUT_PATH}/images', exist_ok=True)
-    
-    print(f'{Colors.RED}PDF loading .....{Colors.RESET}')
-    images = pdf_to_images_high_quality(INPUT_PATH)
-    print(f'{Colors.YELLOW}Loaded {len(images)} pages{Colors.RESET}')
-    
-    # Process each page
-    print(f'{Colors.GREEN}Running OCR inference...{Colors.RESET}')
-    all_results = []
-    
-    for idx, img in enumerate(tqdm(images, desc="OCR inference")):
-        try:
-            # Save image temporarily
-            temp_img_path = f'/tmp/ocr_page_{idx}.jpg'
-            img.save(temp_img_path)
-            
-            # Run inference using official method
-            result = model.infer(
-                tokenizer,
-                prompt=PROMPT,
-                image_file=temp_img_path,
-                output_path=OUTPUT_PATH,
-                base_size=1024,
-                image_size=640,
-                crop_mode=True,
-                save_results=False,
-                test_compress=False
-            )
-            
-            # The infer method prints output but returns None when save_results=False
-            # We need to capture the output differently
-            # For now, just run with save_results=True for the last page to get the format
-            
-            all_results.append(result if result else "")
-            
-            # Clean up temp file
-            os.remove(temp_img_path)
-            
-        except Exception as e:
-            print(f"{Colors.RED}Error processing page {idx + 1}: {e}{Colors.RESET}")
-            all_results.append("")
-    
-    # For multi-page PDFs, run each page and save results
-    print(f'{Colors.BLUE}Processing complete. Running final save...{Colors.RESET}')
+def render_page_jpeg(page, page_path, dpi=None):
+    """
+    Render one PDF page straight to a JPEG file (no PNG encode / PIL decode round trip).
+    dpi=None sizes the page for the model (see page_dpi); pass a number to force a fixed DPI.
+    """
+    zoom = (dpi or page_dpi(page)) / 72.0
+    pixmap = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), alpha=False)
+    pixmap.save(page_path, output="jpeg", jpg_quality=92)
+    return page_path
+
+
+def run_pdf_ocr(model, tokenizer, input_path, output_path, prompt):
+    """Run OCR on every page of a PDF and combine the results into one .mmd"""
+    os.makedirs(output_path, exist_ok=True)
+    os.makedirs(f'{output_path}/images', exist_ok=True)
     
-    # Process all pages and combine results
-    mmd_path = OUTPUT_PATH + '/' + INPUT_PATH.split('/')[-1].replace('.pdf', '.mmd')
+    mmd_path = output_path + '/' + input_path.split('/')[-1].replace('.pdf', '.mmd')
     
-    contents = ''
-    for idx, img in enumerate(tqdm(images, desc="Saving results")):
-        temp_img_path = f'/tmp/ocr_final_{idx}.jpg'
-        img.save(temp_img_path)
+    with tempfile.TemporaryDirectory(prefix='ocr_pages_', dir=PAGE_TMP_DIR) as page_dir, \
+            fitz.open(input_path) as pdf_document, \
+            open(mmd_path, 'w', encoding='utf-8') as mmd_file:
+        print(f'{Colors.RED}PDF loading .....{Colors.RESET}')
+        print(f'{Colors.YELLOW}Loaded {pdf_document.page_count} pages{Colors.RESET}')
         
-        try:
-            # Run with save_results to get proper output
-            page_output_path = f'{OUTPUT_PATH}/page_{idx}'
-            os.makedirs(page_output_path, exist_ok=True)
-            
-            model.infer(
-                tokenizer,
-                prompt=PROMPT,
-                image_file=temp_img_path,
-                output_path=page_output_path,
-                base_size=1024,
-                image_size=640,
-                crop_mode=True,
-                save_results=True,
-                test_compress=False
-            )
-            
-            # Read the result
-            result_file = f'{page_output_path}/result.mmd'
-            if os.path.exists(result_file):
-                with open(result_file, 'r') as f:
-                    page_content = f.read()
-                contents += page_content + f'\n\n<--- Page {idx + 1} --->\n\n'
-        except Exception as e:
-            print(f"{Colors.RED}Error saving page {idx + 1}: {e}{Colors.RESET}")
-        
-        os.remove(temp_img_path)
+        # Render and infer one page at a time, so the tmpfs only ever holds a single page
+        # (one save_results=True pass per page: model.infer takes a single image_file)
+        print(f'{Colors.GREEN}Running OCR inference...{Colors.RESET}')
+        page_path = os.path.join(page_dir, 'page.jpg')
+        for idx in tqdm(range(pdf_document.page_count), desc="OCR inference"):
+            try:
+                render_page_jpeg(pdf_document[idx], page_path)
+                
+                page_output_path = f'{output_path}/page_{idx}'
+                os.makedirs(page_output_path, exist_ok=True)
+                
+                model.infer(
+                    tokenizer,
+                    prompt=prompt,
+                    image_file=page_path,
+                    output_path=page_output_path,
+                    base_size=BASE_SIZE,
+                    image_size=IMAGE_SIZE,
+                    crop_mode=CROP_MODE,
+                    save_results=True,
+                    test_compress=False
+                )
+                
+                # Append the page to the combined .mmd as soon as it is done
+                result_file = f'{page_output_path}/result.mmd'
+                if os.path.exists(result_file):
+                    with open(result_file, 'r', encoding='utf-8') as f:
+                        shutil.copyfileobj(f, mmd_file)
+                    mmd_file.write(f'\n\n<--- Page {idx + 1} --->\n\n')
+            except Exception as e:
+                print(f"{Colors.RED}Error processing page {idx + 1}: {e}{Colors.RESET}")
     
-    # Save combined results
-    with open(mmd_path, 'w', encoding='utf-8') as f:
-        f.write(contents)
+    print(f'{Colors.GREEN}✅ OCR complete! Results saved to {output_path}{Colors.RESET}')
+
+
+if __name__ == "__main__":
+    from config import MODEL_PATH, INPUT_PATH, OUTPUT_PATH, PROMPT
     
-    print(f'{Colors.GREEN}✅ OCR complete! Results saved to {OUTPUT_PATH}{Colors.RESET}')
+    model, tokenizer = load_model(MODEL_PATH)
+    run_pdf_ocr(model, tokenizer, INPUT_PATH, OUTPUT_PATH, PROMPT)
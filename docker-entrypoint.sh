@@ -48,7 +48,7 @@ mkdir -p /app/workspace/uploads /app/workspace/results /app/workspace/logs
 echo ""
 echo "🌐 Starting backend server on port 8002..."
 cd /app/backend
-python -m uvicorn main:app --host 0.0.0.0 --port 8002 &
+python -m uvicorn main:app --host 0.0.0.0 --port 8002 --loop uvloop --http httptools --ws websockets &
 BACKEND_PID=$!
 echo "✅ Backend started (PID: $BACKEND_PID)"
 
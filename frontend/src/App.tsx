@@ -216,7 +216,9 @@ export default function App() {
         
         ws.onmessage = (event) => {
           const message = JSON.parse(event.data);
-          if (message.type === 'log') {
+          if (message.type === 'log_batch') {
+            setConsoleMessages(prev => [...prev, ...message.lines]);
+          } else if (message.type === 'log') {
             setConsoleMessages(prev => [...prev, message.content]);
           }
         };
@@ -65,7 +65,7 @@ fi
 
 echo -e "${YELLOW}>>> Step 2. Starting Backend (Uvicorn)...${RESET}"
 cd backend || cd .
-nohup uvicorn main:app --host 0.0.0.0 --port ${BACKEND_PORT} --reload > ../backend.log 2>&1 &
+nohup uvicorn main:app --host 0.0.0.0 --port ${BACKEND_PORT} --loop uvloop --http httptools --ws websockets --reload > ../backend.log 2>&1 &
 BACK_PID=$!
 echo -e "${GREEN}✅ Backend started (PID: $BACK_PID). Log: backend.log${RESET}"
 cd ..